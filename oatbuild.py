@@ -23,72 +23,68 @@
 #   AddLinkerFlag(...) -> flag1, flag2
 
 import sys
+import re
 import platform
 import os
+import copy
+import functools
+import hashlib
+import shutil
+import subprocess
 import time
-from enum import Enum
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, Optional
 
-class TokenType(Enum):
-    STRING = 1
-    LEFT_PAREN = 2
-    RIGHT_PAREN = 3
-    COMMA = 4
-    LINE_END = 5
+IS_WINDOWS = platform.system() == "Windows"
+EXE_EXTENSION = ".exe" if IS_WINDOWS else ""
+SHARED_LIBRARY_EXTENSION = ".dll" if IS_WINDOWS else ".so"
+OBJECT_EXTENSION = ".obj" if IS_WINDOWS else ".o"
+STATIC_LIBRARY_EXTENSION = ".lib" if IS_WINDOWS else ".a"
+
+CACHE_DIRECTORY = ".oatbuild-cache"
+
+DEFAULT_SHOW_INCLUDES_PREFIX = "Note: including file:"
+DEPENDENCY_SPLIT_RE = re.compile(r"(?<!\\)\s+")
+
+TT_STRING, TT_LEFT_PAREN, TT_RIGHT_PAREN, TT_COMMA, TT_LINE_END = range(5)
+TOKEN_TYPE_NAMES = ("STRING", "LEFT_PAREN", "RIGHT_PAREN", "COMMA", "LINE_END")
 
 
 class Token:
-    def __init__(self, tokenType: int, lexeme: str, line: int):
+    __slots__ = ("tokenType", "lexeme", "line")
+
+    def __init__(self, tokenType: int, lexeme: str, line: int) -> None:
         self.tokenType = tokenType
         self.lexeme = lexeme
         self.line = line
 
-    def print(self) -> None:
-        print(f"[{self.line}]", end = " ")
-
-        if self.tokenType == TokenType.STRING:
-            print("     STRING", end = " ")
-        elif self.tokenType == TokenType.LEFT_PAREN:
-            print(" LEFT_PAREN", end = " ")
-        elif self.tokenType == TokenType.RIGHT_PAREN:
-            print("RIGHT_PAREN", end = " ")
-        elif self.tokenType == TokenType.COMMA:
-            print("      COMMA", end = " ")
-        elif self.tokenType == TokenType.LINE_END:
-            print("   LINE_END", end = " ")
-
-        print(f"{self.lexeme} ")
-
+    @property
+    def location(self) -> str:
+        return f"[{self.line}] at -> \"{self.lexeme}\""
 
 class TokenList:
-    def __init__(self):
-        self.tokens: "list[Token]" = []
-        self.current = 0
-
-    def add(self, tokenType: int, lexeme: str, line: int) -> None:
-        self.tokens.append(Token(tokenType, lexeme, line))
-
-    def advance(self) -> Token:
-        self.current += 1
-        
-        if self.current - 1 >= len(self.tokens):
-            return None
+    __slots__ = ("tokens", "current")
 
-        return self.tokens[self.current - 1]
+    def __init__(self, tokens: "Iterator[Token]") -> None:
+        self.tokens = tokens
+        self.current: Optional[Token] = next(tokens, None)
 
-    def peek(self) -> Token:
-        return self.tokens[self.current]
+    def advance(self) -> Optional[Token]:
+        token = self.current
+        self.current = next(self.tokens, None)
+        return token
 
-    def is_at_end(self) -> bool:
-        return self.current >= len(self.tokens)
+    def peek(self) -> Optional[Token]:
+        return self.current
 
     def skip_line(self) -> None:
         cur = self.advance()
-        while cur != None and cur.tokenType != TokenType.LINE_END:
+        while cur != None and cur.tokenType != TT_LINE_END:
             cur = self.advance()
 
 
 class CompileInfo:
-    def __init__(self):
+    def __init__(self) -> None:
         self.projectName = ""
         self.compiler = "gcc"
         self.languageVersion = "c99"
@@ -105,14 +101,33 @@ class CompileInfo:
         self.linkerFlags: "list[str]" = []
 
 
+class CompilerNotFoundError(Exception):
+    def __init__(self, compiler: str) -> None:
+        super().__init__(compiler)
+        self.compiler = compiler
+
+
 hadError = False
+showIncludesPrefix = DEFAULT_SHOW_INCLUDES_PREFIX.encode()
 
 def main() -> None:
-    buildFile = None
+    global showIncludesPrefix
+    buildFile: Optional[str] = None
+    force = False
+    useCache = True
+    debug = False
     for arg in sys.argv[1:]:
         if arg in {"-h", "--help"}:
             print_help()
             exit(0)
+        elif arg in {"-f", "--force"}:
+            force = True
+        elif arg in {"-n", "--no-cache"}:
+            useCache = False
+        elif arg in {"-d", "--debug"}:
+            debug = True
+        elif arg.startswith("--msvc-deps-prefix="):
+            showIncludesPrefix = encode_console_text(arg[len("--msvc-deps-prefix="):])
         else:
             buildFile = arg
 
@@ -122,220 +137,528 @@ def main() -> None:
 
     tokenList = None
     try:
-        tokenList = scan_file(buildFile)
+        tokens = scan_file(buildFile)
+        if debug:
+            tokens = dump_tokens(tokens)
+        tokenList = TokenList(tokens)
     except OSError:
         print_error(f"File \"{buildFile}\" not found.")
         exit(2)
 
-    #for token in tokenList.tokens:
-    #    token.print()
-
     compileInfo = parse_tokens(tokenList)
+    expand_source_paths(compileInfo)
 
     global hadError
     if hadError:
         exit(1)
 
-    command = build_compile_command(compileInfo)
-    print(command)
+    if compileInfo.outputType == "object":
+        units = split_compile_info(compileInfo)
+        if len(units) == 0:
+            print_error("No source files to compile.")
+        check_object_file_collisions(units)
+        if hadError:
+            exit(1)
+    else:
+        units = [compileInfo]
+
+    if not force:
+        units = [unit for unit in units if not is_up_to_date(unit, buildFile)]
+
+    if len(units) == 0:
+        print("Nothing to do, build is up to date.")
+        return
+
+    commands = [build_compile_command(unit) for unit in units]
 
     start = time.time_ns()
-    result = os.system(command)
+    try:
+        results = run_commands(units, commands, useCache)
+    except CompilerNotFoundError as error:
+        print_error(f"Compiler \"{error.compiler}\" not found.")
+        exit(3)
     end = time.time_ns()
     elapsed = (end - start) / (10 ** 9)
-    if result == 0:
+    if all(result == 0 for result in results):
         print("Compiled successfuly in {0} seconds".format(round(elapsed, 2)))
 
+    if hadError:
+        exit(1)
+
+
+def expand_source_paths(compileInfo: CompileInfo) -> None:
+    knownFiles = {os.path.normpath(file) for file in compileInfo.files}
+    for sourcePath in compileInfo.sourcePaths:
+        sources = []
+        stack = [sourcePath]
+        while stack:
+            try:
+                with os.scandir(stack.pop()) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks = False):
+                            stack.append(entry.path)
+                        elif entry.name.endswith(".c"):
+                            sources.append(entry.path)
+            except OSError:
+                print_error(f"Source path \"{sourcePath}\" could not be read.")
+
+        for source in sorted(sources):
+            normalized = os.path.normpath(source)
+            if normalized not in knownFiles:
+                knownFiles.add(normalized)
+                compileInfo.files.append(source)
+
+
+def split_compile_info(compileInfo: CompileInfo) -> "list[CompileInfo]":
+    units = []
+    for file in compileInfo.files:
+        unit = copy.copy(compileInfo)
+        unit.files = [file]
+        units.append(unit)
+
+    return units
+
+
+def check_object_file_collisions(units: "list[CompileInfo]") -> None:
+    sources: "dict[str, str]" = {}
+    for unit in units:
+        output = get_output_files(unit)[0]
+        #units compile concurrently, two sources must not write the same object
+        if output in sources:
+            print_error(f"Files \"{sources[output]}\" and \"{unit.files[0]}\" both compile to \"{output}\".")
+        else:
+            sources[output] = unit.files[0]
+
+
+def run_commands(units: "list[CompileInfo]", commands: "list[list[str]]", useCache: bool) -> "list[int]":
+    with ThreadPoolExecutor(max_workers = os.cpu_count()) as executor:
+        if useCache:
+            return list(executor.map(run_cached_command, units, commands))
+        else:
+            return list(executor.map(run_command, units, commands))
+
+
+def run_command(compileInfo: CompileInfo, command: "list[str]") -> int:
+    return compile_unit(compileInfo, command)[0]
+
+
+def compile_unit(compileInfo: CompileInfo, command: "list[str]") -> "tuple[int, bytes, bytes]":
+    print_line(str.join(" ", command))
+    process = run_compiler(command)
+    stdout = process.stdout
+    stderr = process.stderr
+
+    isCl = compileInfo.compiler in {"cl", "clang-cl"}
+    includes: "list[str]" = []
+    if isCl:
+        stdout = filter_show_includes(stdout, includes)
+        stderr = filter_show_includes(stderr, includes)
+
+    write_compiler_output(stdout, stderr)
+
+    if process.returncode == 0:
+        if isCl:
+            if not update_cl_dependency_file(compileInfo, includes):
+                return 1, stdout, stderr
+        elif compileInfo.outputType != "object":
+            #a single -MF cannot describe several sources, ask for the rules separately
+            dependencies = run_compiler(build_dependency_command(compileInfo))
+            if dependencies.returncode == 0:
+                try:
+                    with open(get_dependency_file_path(compileInfo), "wb") as file:
+                        file.write(dependencies.stdout)
+                except OSError:
+                    print_error(f"Could not write dependency file \"{get_dependency_file_path(compileInfo)}\".")
+                    return 1, stdout, stderr
+
+    return process.returncode, stdout, stderr
+
+
+def run_compiler(command: "list[str]") -> "subprocess.CompletedProcess[bytes]":
+    try:
+        return subprocess.run(command, capture_output = True)
+    except OSError as error:
+        raise CompilerNotFoundError(command[0]) from error
+
+
+def filter_show_includes(output: bytes, includes: "list[str]") -> bytes:
+    lines = []
+    for line in output.splitlines(keepends = True):
+        if line.startswith(showIncludesPrefix):
+            includes.append(line[len(showIncludesPrefix):].strip().decode(errors = "replace"))
+        else:
+            lines.append(line)
+
+    return bytes().join(lines)
+
+
+def update_cl_dependency_file(compileInfo: CompileInfo, includes: "list[str]") -> bool:
+    try:
+        #no notes usually means a localized prefix, leave the unit out of date instead of missing headers
+        if len(includes) == 0:
+            if os.path.exists(get_dependency_file_path(compileInfo)):
+                os.remove(get_dependency_file_path(compileInfo))
+        else:
+            write_dependency_file(compileInfo, compileInfo.files + includes)
+    except OSError:
+        print_error(f"Could not write dependency file \"{get_dependency_file_path(compileInfo)}\".")
+        return False
+
+    return True
+
+
+def write_compiler_output(stdout: bytes, stderr: bytes) -> None:
+    sys.stdout.buffer.write(stdout)
+    sys.stdout.flush()
+    sys.stderr.buffer.write(stderr)
+    sys.stderr.flush()
+
+
+def encode_console_text(text: str) -> bytes:
+    #cl writes redirected output in the OEM code page, which only exists as a codec on Windows
+    try:
+        return text.encode("oem")
+    except LookupError:
+        return text.encode()
+
+
+def run_cached_command(compileInfo: CompileInfo, command: "list[str]") -> int:
+    if compileInfo.outputType != "object":
+        return run_command(compileInfo, command)
+
+    preprocessed = run_compiler(build_preprocess_command(compileInfo, command))
+    if preprocessed.returncode != 0:
+        return run_command(compileInfo, command)
+
+    key = hashlib.blake2b(preprocessed.stdout)
+    key.update(str.join("\0", command).encode())
+    key.update(get_compiler_version(compileInfo.compiler))
+
+    output = get_output_files(compileInfo)[0]
+    dependencyFile = get_dependency_file_path(compileInfo)
+    cachePrefix = os.path.join(CACHE_DIRECTORY, key.hexdigest())
+    cachedOutput = cachePrefix + get_object_file_extension()
+    cachedDependencyFile = cachePrefix + ".d"
+    cachedStdout = cachePrefix + ".stdout"
+    cachedStderr = cachePrefix + ".stderr"
+    if all(os.path.exists(file) for file in (cachedOutput, cachedDependencyFile, cachedStdout, cachedStderr)):
+        try:
+            shutil.copyfile(cachedDependencyFile, dependencyFile)
+            shutil.copyfile(cachedOutput, output)
+            with open(cachedStdout, "rb") as file:
+                stdout = file.read()
+            with open(cachedStderr, "rb") as file:
+                stderr = file.read()
+        except OSError:
+            pass
+        else:
+            #replay the warnings of the compile that produced the object
+            print_line(f"{compileInfo.files[0]} -> {output} (cached)")
+            write_compiler_output(stdout, stderr)
+            return 0
+
+    result, stdout, stderr = compile_unit(compileInfo, command)
+    if result == 0:
+        try:
+            os.makedirs(CACHE_DIRECTORY, exist_ok = True)
+            write_cache_file(cachedStdout, stdout)
+            write_cache_file(cachedStderr, stderr)
+            shutil.copyfile(dependencyFile, cachedDependencyFile + ".tmp")
+            os.replace(cachedDependencyFile + ".tmp", cachedDependencyFile)
+            shutil.copyfile(output, cachedOutput + ".tmp")
+            os.replace(cachedOutput + ".tmp", cachedOutput)
+        except OSError:
+            pass
+
+    return result
+
+
+def write_cache_file(fileName: str, data: bytes) -> None:
+    with open(fileName + ".tmp", "wb") as file:
+        file.write(data)
+    os.replace(fileName + ".tmp", fileName)
+
+
+def build_preprocess_command(compileInfo: CompileInfo, command: "list[str]") -> "list[str]":
+    preprocessCommand = []
+    args = iter(command)
+    for arg in args:
+        if arg == "-MF":
+            next(args, None)
+        elif arg not in {"-c", "/c", "-MMD", "/showIncludes"} and not arg.startswith("/Fo"):
+            preprocessCommand.append(arg)
 
-def build_compile_command(compileInfo: CompileInfo) -> str:
+    if compileInfo.compiler in {"cl", "clang-cl"}:
+        preprocessCommand.append("/E")
+    else:
+        preprocessCommand.append("-E")
+
+    return preprocessCommand
+
+
+@functools.lru_cache(maxsize = None)
+def get_compiler_version(compiler: str) -> bytes:
+    if compiler == "cl":
+        version = run_compiler([compiler])
+    else:
+        version = run_compiler([compiler, "--version"])
+
+    return version.stdout + version.stderr
+
+
+def build_compile_command(compileInfo: CompileInfo) -> "list[str]":
     if compileInfo.compiler == "gcc":
         return build_gcc_command(compileInfo)
     elif compileInfo.compiler == "clang":
         return build_clang_command(compileInfo)
     elif compileInfo.compiler == "clang-cl":
         return build_clang_cl_command(compileInfo)
-    elif compileInfo.compiler == "cl":
+    else:
         return build_cl_command(compileInfo)
 
 
-def build_gcc_command(compileInfo: CompileInfo) -> str:
-    command = "gcc -Wall -std=" + compileInfo.languageVersion
+def build_gcc_command(compileInfo: CompileInfo) -> "list[str]":
+    command = ["gcc", "-Wall", "-std=" + compileInfo.languageVersion]
     
     if compileInfo.buildType == "release":
-        command = command + " -O2"
+        command.append("-O2")
     else:
-        command = command + " -O0 -g"
+        command.extend(["-O0", "-g"])
 
-    command = command + " -m" + compileInfo.arch
-    command = command + " " + str.join(" ", compileInfo.compilerFlags)
-    command = command + " -D" + str.join(" -D", compileInfo.constants)
-    command = command + " -I" + str.join(" -I", compileInfo.includePaths)
-    command = command + " " + str.join(" ", compileInfo.files)
-    command = command + " " + str.join(" ", compileInfo.sourcePaths)
+    command.append("-m" + compileInfo.arch)
+    command.extend(compileInfo.compilerFlags)
+    command.extend(["-D" + constant for constant in compileInfo.constants])
+    command.extend(["-I" + path for path in compileInfo.includePaths])
+    command.extend(compileInfo.files)
 
     if compileInfo.outputType == "executable":
-        command = command + " -o " + compileInfo.projectName + get_executable_file_extension()
-        command = command + " " + str.join(" ", compileInfo.linkerFlags)
-        command = command + " " + str.join(" ", compileInfo.objectFiles)
-        command = command + " " + str.join(" ", compileInfo.libraries)
+        command.extend(["-o", compileInfo.projectName + get_executable_file_extension()])
+        command.extend(compileInfo.linkerFlags)
+        command.extend(compileInfo.objectFiles)
+        command.extend(compileInfo.libraries)
     
     elif compileInfo.outputType == "shared":
-        command = command + "-shared -o " + compileInfo.projectName + get_executable_file_extension()
-        command = command + " " + str.join(" ", compileInfo.linkerFlags)
-        command = command + " " + str.join(" ", compileInfo.objectFiles)
-        command = command + " " + str.join(" ", compileInfo.libraries)
+        command.extend(["-shared", "-o", compileInfo.projectName + get_executable_file_extension()])
+        command.extend(compileInfo.linkerFlags)
+        command.extend(compileInfo.objectFiles)
+        command.extend(compileInfo.libraries)
 
     elif compileInfo.outputType == "object":
-        command = command + " -c"
+        command.extend(["-c", "-MMD", "-MF", get_dependency_file_path(compileInfo)])
 
     return command
 
 
-def build_clang_command(compileInfo: CompileInfo) -> str:
-    command = "clang -mno-incremental-linker-compatible -Wall -std=" + compileInfo.languageVersion
+def build_clang_command(compileInfo: CompileInfo) -> "list[str]":
+    command = ["clang", "-mno-incremental-linker-compatible", "-Wall", "-std=" + compileInfo.languageVersion]
 
     if compileInfo.buildType == "release":
-        command = command + " -O2"
+        command.append("-O2")
     else:
-        command = command + " -O0 -g"
+        command.extend(["-O0", "-g"])
 
-    command = command + " -m" + compileInfo.arch
-    command = command + " " + str.join(" ", compileInfo.compilerFlags)
-    command = command + " -D" + str.join(" -D", compileInfo.constants)
-    command = command + " -I" + str.join(" -I", compileInfo.includePaths)
-    command = command + " " + str.join(" ", compileInfo.files)
-    command = command + " " + str.join(" ", compileInfo.sourcePaths)
+    command.append("-m" + compileInfo.arch)
+    command.extend(compileInfo.compilerFlags)
+    command.extend(["-D" + constant for constant in compileInfo.constants])
+    command.extend(["-I" + path for path in compileInfo.includePaths])
+    command.extend(compileInfo.files)
 
     if compileInfo.outputType == "executable":
-        command = command + " -o " + compileInfo.projectName + get_executable_file_extension()
-        command = command + " " + str.join(" ", compileInfo.linkerFlags)
-        command = command + " " + str.join(" ", compileInfo.objectFiles)
-        command = command + " " + str.join(" ", compileInfo.libraries)
+        command.extend(["-o", compileInfo.projectName + get_executable_file_extension()])
+        command.extend(compileInfo.linkerFlags)
+        command.extend(compileInfo.objectFiles)
+        command.extend(compileInfo.libraries)
     
     elif compileInfo.outputType == "shared":
-        command = command + "-shared -o " + compileInfo.projectName + get_executable_file_extension()
-        command = command + " " + str.join(" ", compileInfo.linkerFlags)
-        command = command + " " + str.join(" ", compileInfo.objectFiles)
-        command = command + " " + str.join(" ", compileInfo.libraries)
+        command.extend(["-shared", "-o", compileInfo.projectName + get_executable_file_extension()])
+        command.extend(compileInfo.linkerFlags)
+        command.extend(compileInfo.objectFiles)
+        command.extend(compileInfo.libraries)
 
     elif compileInfo.outputType == "object":
-        command = command + " -c"
+        command.extend(["-c", "-MMD", "-MF", get_dependency_file_path(compileInfo)])
 
     return command
 
 
-def build_clang_cl_command(compileInfo: CompileInfo) -> str:
-    command = "clang-cl /FC /W4 -Xclang -std=" + compileInfo.languageVersion + " -m" + compileInfo.arch
+def build_clang_cl_command(compileInfo: CompileInfo) -> "list[str]":
+    command = ["clang-cl", "/FC", "/W4", "/showIncludes", "-Xclang", "-std=" + compileInfo.languageVersion, "-m" + compileInfo.arch]
 
     if compileInfo.buildType == "release":
-        command = command + " /O2 /Oi /fp:fast"
+        command.extend(["/O2", "/Oi", "/fp:fast"])
     else:
-        command = command + " /Od /Zi"
+        command.extend(["/Od", "/Zi"])
 
-    command = command + " " + str.join(" ", compileInfo.compilerFlags)
-    command = command + " -D" + str.join(" -D", compileInfo.constants)
-    command = command + " -I" + str.join(" -I", compileInfo.includePaths)
-    command = command + " " + str.join(" ", compileInfo.files)
-    command = command + " " + str.join(" ", compileInfo.sourcePaths)
+    command.extend(compileInfo.compilerFlags)
+    command.extend(["/D" + constant for constant in compileInfo.constants])
+    command.extend(["/I" + path for path in compileInfo.includePaths])
+    command.extend(compileInfo.files)
 
     if compileInfo.outputType == "executable":
-        command = command + " /o " + compileInfo.projectName + get_executable_file_extension()
-        command = command + " /link /INCREMENTAL:NO /OPT:REF " + str.join(" ", compileInfo.linkerFlags)
-        command = command + " " + str.join(" ", compileInfo.objectFiles)
-        command = command + " " + str.join(" ", compileInfo.libraries)
+        command.extend(["/o", compileInfo.projectName + get_executable_file_extension()])
+        command.extend(["/link", "/INCREMENTAL:NO", "/OPT:REF"])
+        command.extend(compileInfo.linkerFlags)
+        command.extend(compileInfo.objectFiles)
+        command.extend(compileInfo.libraries)
     
     elif compileInfo.outputType == "shared":
-        command = command + " /o " + compileInfo.projectName + get_executable_file_extension()
-        command = command + " /link /INCREMENTAL:NO /OPT:REF " + str.join(" ", compileInfo.linkerFlags)
-        command = command + " " + str.join(" ", compileInfo.objectFiles)
-        command = command + " " + str.join(" ", compileInfo.libraries) + " /DLL"
+        command.extend(["/o", compileInfo.projectName + get_executable_file_extension()])
+        command.extend(["/link", "/INCREMENTAL:NO", "/OPT:REF"])
+        command.extend(compileInfo.linkerFlags)
+        command.extend(compileInfo.objectFiles)
+        command.extend(compileInfo.libraries)
+        command.append("/DLL")
 
     elif compileInfo.outputType == "object":
-        command = command + " /c /Fo\"" + compileInfo.outputType + "\"\\"
+        command.extend(["/c", "/Fo" + compileInfo.outputType + "\\"])
 
     return command
 
 
-def build_cl_command(compileInfo: CompileInfo) -> str:    
-    command = "cl /FC /W4 /std:" + compileInfo.languageVersion
+def build_cl_command(compileInfo: CompileInfo) -> "list[str]":
+    command = ["cl", "/FC", "/W4", "/showIncludes", "/std:" + compileInfo.languageVersion]
 
     if compileInfo.buildType == "release":
-        command = command + " /O2 /Oi /fp:fast"
+        command.extend(["/O2", "/Oi", "/fp:fast"])
     else:
-        command = command + " /Od /Zi"
+        command.extend(["/Od", "/Zi", "/FS"])
 
-    command = command + " " + str.join(" ", compileInfo.compilerFlags)
-    command = command + " -D" + str.join(" -D", compileInfo.constants)
-    command = command + " -I" + str.join(" -I", compileInfo.includePaths)
-    command = command + " " + str.join(" ", compileInfo.files)
-    command = command + " " + str.join(" ", compileInfo.sourcePaths)
+    command.extend(compileInfo.compilerFlags)
+    command.extend(["/D" + constant for constant in compileInfo.constants])
+    command.extend(["/I" + path for path in compileInfo.includePaths])
+    command.extend(compileInfo.files)
 
     if compileInfo.outputType == "executable":
-        command = command + " /link /INCREMENTAL:NO /OPT:REF " + str.join(" ", compileInfo.linkerFlags)
-        command = command + " " + str.join(" ", compileInfo.objectFiles)
-        command = command + " " + str.join(" ", compileInfo.libraries)
-        command = command + " /OUT:" + compileInfo.projectName + get_executable_file_extension()
+        command.extend(["/link", "/INCREMENTAL:NO", "/OPT:REF"])
+        command.extend(compileInfo.linkerFlags)
+        command.extend(compileInfo.objectFiles)
+        command.extend(compileInfo.libraries)
+        command.append("/OUT:" + compileInfo.projectName + get_executable_file_extension())
     
     elif compileInfo.outputType == "shared":
-        command = command + " /link /INCREMENTAL:NO /OPT:REF " + str.join(" ", compileInfo.linkerFlags)
-        command = command + " " + str.join(" ", compileInfo.objectFiles)
-        command = command + " " + str.join(" ", compileInfo.libraries) + " /DLL"
-        command = command + " /OUT:" + compileInfo.projectName + get_executable_file_extension()
+        command.extend(["/link", "/INCREMENTAL:NO", "/OPT:REF"])
+        command.extend(compileInfo.linkerFlags)
+        command.extend(compileInfo.objectFiles)
+        command.extend(compileInfo.libraries)
+        command.append("/DLL")
+        command.append("/OUT:" + compileInfo.projectName + get_executable_file_extension())
 
     elif compileInfo.outputType == "object":
-        command = command + " /c /Fo\"" + compileInfo.outputType + "\"\\"
+        command.extend(["/c", "/Fo" + compileInfo.outputType + "\\"])
 
     return command
 
 
-def get_cl_libraries(libraries: str) -> str:
-    result = ""
-    for lib in libraries:
-        result = result + " " + lib
-    return result
+def get_output_files(compileInfo: CompileInfo) -> "list[str]":
+    if compileInfo.outputType == "object":
+        return [get_object_file_path(compileInfo, file) for file in compileInfo.files]
+    else:
+        return [compileInfo.projectName + get_executable_file_extension()]
 
 
-def get_executable_file_extension() -> str:
-    osName = platform.system()
-    if osName == "Windows":
-        return ".exe"
+def get_object_file_path(compileInfo: CompileInfo, file: str) -> str:
+    objectName = os.path.splitext(os.path.basename(file))[0] + get_object_file_extension()
+    if compileInfo.compiler in {"cl", "clang-cl"}:
+        return os.path.join(compileInfo.outputType, objectName)
     else:
-        return ""
+        return objectName
+
+
+def get_dependency_file_path(compileInfo: CompileInfo) -> str:
+    return os.path.splitext(get_output_files(compileInfo)[0])[0] + ".d"
+
+
+def build_dependency_command(compileInfo: CompileInfo) -> "list[str]":
+    command = [compileInfo.compiler, "-std=" + compileInfo.languageVersion, "-m" + compileInfo.arch]
+    command.extend(compileInfo.compilerFlags)
+    command.extend(["-D" + constant for constant in compileInfo.constants])
+    command.extend(["-I" + path for path in compileInfo.includePaths])
+    command.append("-MM")
+    command.extend(compileInfo.files)
+    return command
+
+
+def write_dependency_file(compileInfo: CompileInfo, dependencies: "list[str]") -> None:
+    escaped = [dependency.replace(" ", "\\ ") for dependency in dependencies]
+    with open(get_dependency_file_path(compileInfo), "w") as file:
+        file.write(get_output_files(compileInfo)[0].replace(" ", "\\ ") + ": " + str.join(" ", escaped) + "\n")
+
+
+def read_dependency_file(fileName: str) -> "list[str]":
+    with open(fileName) as file:
+        data = file.read()
+
+    dependencies = []
+    for rule in data.replace("\\\n", " ").splitlines():
+        target, separator, prerequisites = rule.partition(": ")
+        if separator == "":
+            continue
+
+        for prerequisite in DEPENDENCY_SPLIT_RE.split(prerequisites.strip()):
+            if prerequisite != "":
+                dependencies.append(prerequisite.replace("\\ ", " "))
+
+    return dependencies
+
+
+def is_up_to_date(compileInfo: CompileInfo, buildFile: str) -> bool:
+    outputs = get_output_files(compileInfo)
+    if len(outputs) == 0:
+        return False
+
+    try:
+        #headers are only known through the dependency file written by the last compile
+        dependencies = read_dependency_file(get_dependency_file_path(compileInfo))
+        oldestOutput = min(os.path.getmtime(output) for output in outputs)
+        newestInput = max(os.path.getmtime(file) for file in compileInfo.files + compileInfo.objectFiles + dependencies + [buildFile])
+    except OSError:
+        return False
+
+    return oldestOutput >= newestInput
+
+
+def get_cl_libraries(libraries: "list[str]") -> str:
+    return str.join(" ", libraries)
+
+
+def get_executable_file_extension() -> str:
+    return EXE_EXTENSION
 
 
 def get_shared_library_file_extension() -> str:
-    osName = platform.system()
-    if osName == "Windows":
-        return ".dll"
-    else:
-        return ".so"
+    return SHARED_LIBRARY_EXTENSION
 
 
 def get_object_file_extension() -> str:
-    osName = platform.system()
-    if osName == "Windows":
-        return ".obj"
-    else:
-        return ".o"
+    return OBJECT_EXTENSION
 
 
 def get_static_library_file_extension() -> str:
-    osName = platform.system()
-    if osName == "Windows":
-        return ".lib"
-    else:
-        return ".a"
+    return STATIC_LIBRARY_EXTENSION
+
+
+def print_line(line: str) -> None:
+    #units run on several threads, keep each line in a single write
+    sys.stdout.write(line + "\n")
 
 
-def print_error(*args, **kwdargs) -> None:
+def print_error(*args: str) -> None:
     global hadError
     hadError = True
-    print(*args, file = sys.stderr, **kwdargs)
+    sys.stderr.write(str.join(" ", args) + "\n")
 
 
 def print_help() -> None:
     help = """\
-Usage: oatbuild -h --help \"buildfile\"
+Usage: oatbuild -h --help -f --force -n --no-cache -d --debug --msvc-deps-prefix=x \"buildfile\"
+
+Options:
+        -h --help -> show this message
+        -f --force -> rebuild even if the output is up to date
+        -n --no-cache -> always run the compiler instead of reusing cached objects
+                         (the cache in .oatbuild-cache is never pruned, delete it to free space)
+        -d --debug -> print every token read from the build file
+        --msvc-deps-prefix=x -> /showIncludes prefix of a localized cl (default \"Note: including file:\")
 
 Command list:
         SetProjectName(x) -> projectName
@@ -355,171 +678,128 @@ Command list:
     print(help)
 
 
-def is_valid_character(c: str) -> bool:
-    return c.isalnum() or c in {"_", "-", ".", "/", "\\", ":", "="}
+TOKEN_RE = re.compile(rb"([A-Za-z0-9_\-./\\:=]+)|([()\n,])|[ \t\r\0]+|([^A-Za-z0-9_\-./\\:=()\n, \t\r\0]+)")
+
+PUNCTUATION = {
+    b"(": (TT_LEFT_PAREN, "("),
+    b")": (TT_RIGHT_PAREN, ")"),
+    b",": (TT_COMMA, ","),
+}
+
+
+def scan_file(fileName: str) -> "Iterator[Token]":
+    with open(fileName, "rb") as file:
+        data = file.read()
+
+    line: int = 1
+    lineIsEmpty: bool = True
+    for match in TOKEN_RE.finditer(data):
+        string, punctuation, invalid = match.groups()
+        if string != None:
+            lexeme = string.decode()
+            #command names and option values repeat, share one string object
+            if lexeme.isidentifier():
+                lexeme = sys.intern(lexeme)
+            yield Token(TT_STRING, lexeme, line)
+            lineIsEmpty = False
+        elif punctuation != None:
+            if punctuation == b"\n":
+                #empty new lines skipped
+                if not lineIsEmpty:
+                    yield Token(TT_LINE_END, "\\n", line)
+                line += 1
+                lineIsEmpty = True
+            else:
+                tokenType, lexeme = PUNCTUATION[punctuation]
+                yield Token(tokenType, lexeme, line)
+                lineIsEmpty = False
+        elif invalid != None:
+            print_error(f"[{line}] at -> \"{invalid.decode(errors = 'replace')}\" Invalid character.")
 
 
-def scan_file(fileName: str) -> TokenList:
-    tokenList = TokenList()
+def dump_tokens(tokens: "Iterator[Token]") -> "Iterator[Token]":
+    for token in tokens:
+        dump_token(token)
+        yield token
+
+
+def dump_token(token: Token) -> None:
+    print(f"[{token.line}] {TOKEN_TYPE_NAMES[token.tokenType]:>11} {token.lexeme} ")
 
-    with open(fileName) as file:
-        for index, line in enumerate(file):
-            #empty new lines skipped
-            if line[0] == "\n":
-                continue
-
-            tokenStart = 0
-            tokenEnd = 0
-
-            while tokenStart < len(line):
-                c = line[tokenStart]
-                if c == "(":
-                    tokenList.add(TokenType.LEFT_PAREN, "(", index + 1)
-                elif c == ")":
-                    tokenList.add(TokenType.RIGHT_PAREN, ")", index + 1)
-                elif c == ",":
-                    tokenList.add(TokenType.COMMA, ",", index + 1)
-                elif c == "\n":
-                    tokenList.add(TokenType.LINE_END, "\\n", index + 1)
-                elif c in {" ", "\t", "\0"}:
-                    pass
-                else:
-                    while tokenEnd < len(line) and is_valid_character(line[tokenEnd]):
-                        tokenEnd += 1
-                    tokenList.add(TokenType.STRING, line[tokenStart:tokenEnd], index + 1)
-
-                tokenStart = tokenEnd
-                tokenEnd += 1
-
-    return tokenList
 
 def parse_tokens(tokenList: TokenList) -> CompileInfo:
     compileInfo = CompileInfo()
     
-    while(not tokenList.is_at_end()):
-        token = tokenList.peek()
-        
-        if token.tokenType == TokenType.STRING:
+    token = tokenList.peek()
+    while(token != None):
+        if token.tokenType == TT_STRING:
             handle_command(tokenList, compileInfo)
         else:
-            print_error(f"[{token.line}] at -> \"{token.lexeme}\" Commands must begin with a string.")
+            print_error(token.location, "Commands must begin with a string.")
             tokenList.skip_line()
 
-    return compileInfo
+        token = tokenList.peek()
 
+    return compileInfo
 
-def handle_command(tokenList: TokenList, compileInfo: CompileInfo) -> None:
-    command = tokenList.advance()
-    
-    if command.lexeme == "SetProjectName":
-        param = simple_command(tokenList, command)
-        if param != None:
-            compileInfo.projectName = param.lexeme
 
-    elif command.lexeme == "SetCompiler":
-        param = simple_command(tokenList, command)
-        if param != None:
-            compiler = param.lexeme
-            if compiler in {"gcc", "cl", "clang", "clang-cl"}:
-                compileInfo.compiler = compiler
-            else:
-                print_error(f"[{param.line}] at -> \"{param.lexeme}\" Invalid compiler.")
+SIMPLE_COMMANDS = {
+    "SetProjectName": ("projectName", None, ""),
+    "SetCompiler": ("compiler", {"gcc", "cl", "clang", "clang-cl"}, "Invalid compiler."),
+    "SetLanguageVersion": ("languageVersion", {"c89", "c99", "c11", "c17"}, "Invalid language version."),
+    "SetTargetArch": ("arch", {"32", "64"}, "Invalid architeture."),
+    "SetOutputType": ("outputType", {"shared", "object", "executable"}, "Invalid output type."),
+    "SetBuildType": ("buildType", {"debug", "release"}, "Invalid build type."),
+}
 
-    elif command.lexeme == "SetLanguageVersion":
-        param = simple_command(tokenList, command)
-        if param != None:
-            version = param.lexeme
-            if version in {"c89", "c99", "c11", "c17"}:
-                compileInfo.languageVersion = version
-            else:
-                print_error(f"[{param.line}] at -> \"{param.lexeme}\" Invalid language version.")
+LIST_COMMANDS = {
+    "AddFile": ("files", ""),
+    "AddSourcePath": ("sourcePaths", ""),
+    "AddConstant": ("constants", ""),
+    "AddIncludePath": ("includePaths", ""),
+    "AddLibrary": ("libraries", get_static_library_file_extension()),
+    "AddObjectFile": ("objectFiles", get_object_file_extension()),
+    "AddCompilerFlag": ("compilerFlags", ""),
+    "AddLinkerFlag": ("linkerFlags", ""),
+}
 
-    elif command.lexeme == "SetTargetArch":
-        param = simple_command(tokenList, command)
-        if param != None:
-            arch = param.lexeme
-            if arch in {"32", "64"}:
-                compileInfo.arch = arch
-            else:
-                print_error(f"[{param.line}] at -> \"{param.lexeme}\" Invalid architeture.")
-        
-    elif command.lexeme == "SetOutputType":
-        param = simple_command(tokenList, command)
-        if param != None:
-            outputType = param.lexeme
-            if outputType in {"shared", "object", "executable"}:
-                compileInfo.outputType = outputType
-            else:
-                print_error(f"[{param.line}] at -> \"{param.lexeme}\" Invalid output type.")
 
-    elif command.lexeme == "SetBuildType":
+def handle_command(tokenList: TokenList, compileInfo: CompileInfo) -> None:
+    command = tokenList.advance()
+    if command == None:
+        return
+    
+    simpleCommand = SIMPLE_COMMANDS.get(command.lexeme)
+    if simpleCommand != None:
+        attribute, validValues, errorMessage = simpleCommand
         param = simple_command(tokenList, command)
         if param != None:
-            buildType = param.lexeme
-            if buildType in {"debug", "release"}:
-                compileInfo.buildType = buildType
+            if validValues == None or param.lexeme in validValues:
+                setattr(compileInfo, attribute, param.lexeme)
             else:
-                print_error(f"[{param.line}] at -> \"{param.lexeme}\" Invalid build type.")
-        
-    elif command.lexeme == "AddFile":
-        params = complex_command(tokenList, command)
-        if params != None:
-            for param in params:
-                compileInfo.files.append("\"" + param.lexeme + "\"")
-
-    elif command.lexeme == "AddSourcePath":
-        params = complex_command(tokenList, command)
-        if params != None:
-            for param in params:
-                compileInfo.sourcePaths.append("\"" + param.lexeme + "\"")
-        
-    elif command.lexeme == "AddConstant":
-        params = complex_command(tokenList, command)
-        if params != None:
-            for param in params:
-                compileInfo.constants.append(param.lexeme)
-        
-    elif command.lexeme == "AddIncludePath":
-        params = complex_command(tokenList, command)
-        if params != None:
-            for param in params:
-                compileInfo.includePaths.append("\"" + param.lexeme + "\"")
-
-    elif command.lexeme == "AddLibrary":
-        params = complex_command(tokenList, command)
-        if params != None:
-            for param in params:
-                compileInfo.libraries.append("\"" + param.lexeme + get_static_library_file_extension() + "\"")
-
-    elif command.lexeme == "AddObjectFile":
-        params = complex_command(tokenList, command)
-        if params != None:
-            for param in params:
-                compileInfo.objectFiles.append("\"" + param.lexeme + get_object_file_extension() + "\"")
-        
-    elif command.lexeme == "AddCompilerFlag":
-        params = complex_command(tokenList, command)
-        if params != None:
-            for param in params:
-                compileInfo.compilerFlags.append(param.lexeme)
+                print_error(param.location, errorMessage)
+        return
 
-    elif command.lexeme == "AddLinkerFlag":
+    listCommand = LIST_COMMANDS.get(command.lexeme)
+    if listCommand != None:
+        attribute, suffix = listCommand
         params = complex_command(tokenList, command)
         if params != None:
+            values = getattr(compileInfo, attribute)
             for param in params:
-                compileInfo.linkerFlags.append(param.lexeme)
+                values.append(param.lexeme + suffix)
+        return
 
-    else:
-        print_error(f"[{command.line}] at -> \"{command.lexeme}\" Unkown command.")
-        tokenList.skip_line(command)
+    print_error(command.location, "Unkown command.")
+    tokenList.skip_line()
 
 
-def complex_command(tokenList: TokenList, command: Token) -> "list[Token]":
+def complex_command(tokenList: TokenList, command: Token) -> "Optional[list[Token]]":
     params = get_complex_command_params(tokenList, command)
     if params == None and hadError == True:
         tokenList.skip_line()
     elif params == None:
-        print_error(f"[{command.line}] at -> \"{command.lexeme}\" Expected parameters after command.")
+        print_error(command.location, "Expected parameters after command.")
         tokenList.skip_line()
     else:
         tokenList.skip_line()
@@ -528,52 +808,47 @@ def complex_command(tokenList: TokenList, command: Token) -> "list[Token]":
     return None
 
 
-def get_complex_command_params(tokenList: TokenList, command: Token) -> "list[Token]":
+def get_complex_command_params(tokenList: TokenList, command: Token) -> "Optional[list[Token]]":
     lparen = tokenList.advance()
-    if lparen == None or lparen.tokenType != TokenType.LEFT_PAREN:
-        print_error(f"[{command.line}] at -> \"{command.lexeme}\" Expected \"(\" after command.")
+    if lparen == None or lparen.tokenType != TT_LEFT_PAREN:
+        print_error(command.location, "Expected \"(\" after command.")
         return None
 
-    params = []
-    consume_param(tokenList, params)
+    params: "list[Token]" = []
+    consume_params(tokenList, params)
     if len(params) == 0:
         return None
 
     rparen = tokenList.advance()
-    if rparen == None or rparen.tokenType != TokenType.RIGHT_PAREN:
-        print_error(f"[{command.line}] at -> \"{command.lexeme}\" Expected \")\" after parameters.")
+    if rparen == None or rparen.tokenType != TT_RIGHT_PAREN:
+        print_error(command.location, "Expected \")\" after parameters.")
         return None
 
     return params
 
 
-def consume_param(tokenList: TokenList, result: "list[Token]") -> None:
-    param = tokenList.peek()
-    if param == None:
-        return
+def consume_params(tokenList: TokenList, result: "list[Token]") -> None:
+    while True:
+        param = tokenList.peek()
+        if param == None or param.tokenType != TT_STRING:
+            return
 
-    if param.tokenType == TokenType.STRING:
         tokenList.advance()
         result.append(param)
-        consume_comma(tokenList, result)
 
+        comma = tokenList.peek()
+        if comma == None or comma.tokenType != TT_COMMA:
+            return
 
-def consume_comma(tokenList: TokenList, result: "list[Token]") -> None:
-    comma = tokenList.peek()
-    if comma == None:
-        return
-
-    if comma.tokenType == TokenType.COMMA:
         tokenList.advance()
-        consume_param(tokenList, result)
 
 
-def simple_command(tokenList: TokenList, command: Token) -> Token:
+def simple_command(tokenList: TokenList, command: Token) -> Optional[Token]:
     param = get_simple_command_param(tokenList, command)
     if param == None and hadError == True:
         tokenList.skip_line()
     elif param == None:
-        print_error(f"[{command.line}] at -> \"{command.lexeme}\" Expected parameter after command.")
+        print_error(command.location, "Expected parameter after command.")
         tokenList.skip_line()
     else:
         tokenList.skip_line()
@@ -582,10 +857,10 @@ def simple_command(tokenList: TokenList, command: Token) -> Token:
     return None
 
 
-def get_simple_command_param(tokenList: TokenList, command: Token) -> Token:
+def get_simple_command_param(tokenList: TokenList, command: Token) -> Optional[Token]:
     lparen = tokenList.advance()
-    if lparen == None or lparen.tokenType != TokenType.LEFT_PAREN:
-        print_error(f"[{command.line}] at -> \"{command.lexeme}\" Expected \"(\" after command.")
+    if lparen == None or lparen.tokenType != TT_LEFT_PAREN:
+        print_error(command.location, "Expected \"(\" after command.")
         return None
 
     param = tokenList.advance()
@@ -593,8 +868,8 @@ def get_simple_command_param(tokenList: TokenList, command: Token) -> Token:
         return None
 
     rparen = tokenList.advance()
-    if rparen == None or rparen.tokenType != TokenType.RIGHT_PAREN:
-        print_error(f"[{command.line}] at -> \"{command.lexeme}\" Expected \")\" after parameter.")
+    if rparen == None or rparen.tokenType != TT_RIGHT_PAREN:
+        print_error(command.location, "Expected \")\" after parameter.")
         return None
 
     return param